@@ -11,16 +11,27 @@ import os
 import re
 import sys
 import shutil
+import pathlib
+import functools
+import concurrent.futures
 import stdoc.stmarkdown
 import stdoc.collect
 from typing import Tuple
+from stdoc.pageinfo import PageInfo
 from stdoc.util import *
 
 USAGE = """\
 stdoc -- a simple documentation generator
-usage: stdoc <folder>
+usage: stdoc [--no-cache] [-j <jobs>] <folder>
+
+Options:
+  --no-cache    Don't reuse parsing results and templates from previous runs
+  -j <jobs>     Number of processes used for parsing (default: CPU count)
 """
 
+# Folder (relative to CWD) where data reused between runs is stored
+CACHE_FOLDER = ".stdoc-cache"
+
 def usage(exitcode):
     print(USAGE, end="")
     return exitcode
@@ -28,12 +39,29 @@ def usage(exitcode):
 def main(argv):
     if "-h" in argv or "--help" in argv:
         return usage(0)
-    if len(argv) != 2:
+
+    folder = None
+    cacheFolder = CACHE_FOLDER
+    jobs = os.cpu_count() or 1
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--no-cache":
+            cacheFolder = None
+        elif arg.startswith("-j"):
+            try:
+                jobs = int(arg[2:] or next(args))
+            except (ValueError, StopIteration):
+                return usage(1)
+        elif arg.startswith("-") or folder is not None:
+            return usage(1)
+        else:
+            folder = arg
+    if folder is None:
         return usage(1)
 
-    # FIXME: Paths and IDs should be relative to argv[1], not CWD.
+    # FIXME: Paths and IDs should be relative to the folder, not CWD.
 
-    mainBundle = stdoc.collect.loadBundle(argv[1], recursive=True)
+    mainBundle = stdoc.collect.loadBundle(folder, recursive=True)
     if mainBundle is None:
         return 1
 
@@ -43,7 +71,7 @@ def main(argv):
 
     # Parse input files to get their metadata and assign their URLs
     md = stdoc.stmarkdown.make_Markdown()
-    stdoc.collect.initialParse(mainBundle, md)
+    stdoc.collect.initialParse(mainBundle, md, cacheFolder, jobs)
     stdoc.collect.summaryTable(mainBundle)
 
     # TODO: Extract more labels than just page label
@@ -52,53 +80,94 @@ def main(argv):
 
     # Link pages together to resolve inter-page references
     pages = mainBundle.pagesRecursively()
-    crossref_pages(pages)
+    ctx = RefContext(pages)
+    crossref_pages(pages, ctx)
 
     # Generate final HTML output (this also does some reference resolution)
-    generate_html(mainBundle, pages, md)
+    generate_html(mainBundle, pages, ctx, md, cacheFolder)
 
-    # Also copy static files
-    print("Copying static files")
+    # Also copy static files and raw files
+    copies = []
     for b in mainBundle.iterBundles():
         for static in b._statics:
             src = os.path.join(b._dir, static, "_static")
             dst = os.path.join(b.config("outputs.folder"), "static", b._dir, static)
-            print(" ", src, "->", dst)
-            shutil.copytree(src, dst, dirs_exist_ok=True)
+            copies.append((src, dst, copy_function(b)))
 
     files = mainBundle.config("inputs.files")
     if files is not None:
-        print("Copying raw files")
         for ff in stdoc.collect.filesystemSearch(".", files):
-            print(" ", ff, "->", mainBundle.config("outputs.folder"))
-            shutil.copytree(ff, mainBundle.config("outputs.folder"),
-                            dirs_exist_ok=True)
+            copies.append((ff, mainBundle.config("outputs.folder"),
+                           copy_function(mainBundle)))
+
+    print("Copying static and raw files")
+    copy_trees(copies)
+
+# Static files are hard-linked by default since outputs are not supposed to be
+# modified in-place; `static.copy_mode` can select another mode of `copy_file`.
+def copy_function(bundle):
+    mode = bundle.config("static.copy_mode", "link")
+    if mode not in COPY_MODES:
+        warn(f"{bundle._dir}: invalid static.copy_mode '{mode}', using 'copy'")
+        mode = "copy"
+    return functools.partial(copy_file, mode=mode)
+
+# Copying is I/O-bound so files within a tree are copied in parallel. Trees are
+# still copied one after the other in order, so that a file present in several
+# trees always ends up with the version from the last one.
+def copy_trees(copies):
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for src, dst, copy_function in copies:
+            print(" ", src, "->", dst)
+            futures = []
+            def submit(s, d):
+                futures.append(executor.submit(copy_function, s, d))
+                return d
+            shutil.copytree(src, dst, dirs_exist_ok=True, copy_function=submit)
+            for f in futures:
+                f.result()
 
 #---
 # Cross-file referencing and patching
 #---
 
-unresolved_labels = set()
-
-def resolve_label(pages, sourcePage, label, lang) -> Tuple[Url | None, str]:
+class RefContext:
+    """State of label resolution for one run. Labels of all pages are indexed
+       so they can be resolved without scanning every page; labels that can't
+       be resolved are recorded along with the pages referencing them."""
+
+    # Maps absolute label names to the (lang, target, title) of definitions
+    labels: dict[str, list[Tuple[str, Url, str]]]
+    # Maps unresolved absolute label names to the pages that use them
+    unresolved: dict[str, list[PageInfo]]
+
+    def __init__(self, pages):
+        self.labels = dict()
+        self.unresolved = dict()
+        for p in pages.values():
+            for l, target in p.labels.items():
+                self.labels.setdefault(l, []).append((p.lang, target, p.title))
+
+    def addUnresolved(self, label: str, page: PageInfo) -> None:
+        sources = self.unresolved.setdefault(label, [])
+        if not any(p is page for p in sources):
+            sources.append(page)
+
+def resolve_label(ctx, sourcePage, label, lang) -> Tuple[Url | None, str]:
     # Relative to absolute path
     if not label.startswith(":"):
         label = sourcePage.label_namespace + ":" + label
-    found = []
-    for p in pages.values():
-        if p.lang is not None and lang is not None and p.lang != lang:
-            continue
-        for l, target in p.labels.items():
-            if l == label:
-                found.append((target, p.title))
+    found = [(target, title) for l, target, title in ctx.labels.get(label, [])
+             if l is None or lang is None or l == lang]
     if len(found) == 0:
-        unresolved_labels.add(label)
+        ctx.addUnresolved(label, sourcePage)
         return None, ""
     elif len(found) > 1:
         err(f"multiple definitions of label @{label} found")
     return found[0]
 
-def replace_url(p, url, pages):
+def replace_url(p, url, ctx):
     if url is None:
         return None, None, None
     if url.startswith("="):
@@ -106,112 +175,192 @@ def replace_url(p, url, pages):
     if url.startswith("=:"):
         return p.relpath(p.globalStaticUrl() / url[2:]), None, None
     if url.startswith("@"):
-        target, title = resolve_label(pages, p, url[1:], p.lang)
+        target, title = resolve_label(ctx, p, url[1:], p.lang)
         if target is None:
             return None, None, None
         else:
             return p.relpath(target), url, title
     return url, None, None
 
-def patch_static_urls(p, tree, pages):
-    for a in tree.iterfind(".//a"):
-        new_url, old_text, new_text = replace_url(p, a.get("href"), pages)
+# Only URLs with these prefixes are rewritten by replace_url()
+SPECIAL_URL_PREFIXES = ("@", "=")
+
+def patch_static_urls(p, tree, ctx):
+    for el in tree.iter():
+        if el.tag == "a":
+            attr = "href"
+        elif el.tag == "img":
+            attr = "src"
+        else:
+            continue
+        url = el.get(attr)
+        if url is None or not url.startswith(SPECIAL_URL_PREFIXES):
+            continue
+
+        new_url, old_text, new_text = replace_url(p, url, ctx)
         if new_url is None:
-            a.attrib.pop("href")
-            a.set("class", "broken")
+            el.attrib.pop(attr)
+            el.set("class", "broken")
         else:
-            a.set("href", new_url)
-            if a.text == old_text:
-                a.text = new_text
-    for img in tree.iterfind(".//img"):
-        img.set("src", replace_url(p, img.get("src"), pages))
+            el.set(attr, new_url)
+            if el.tag == "a" and el.text == old_text:
+                el.text = new_text
 
 # Patch URLs in the Markdown trees
-def crossref_pages(pages):
+def crossref_pages(pages, ctx):
     for path, p in pages.items():
         inputStatic = p.bundle.localStaticFromPath(path)
         urlStatic = os.path.join("/static", p.bundle._dir, inputStatic)
         p.local_static = Url(os.path.normpath(urlStatic))
-        patch_static_urls(p, p.tree, pages)
+        patch_static_urls(p, p.tree, ctx)
         for frag in p.fragments.values():
-            patch_static_urls(p, frag, pages)
+            patch_static_urls(p, frag, ctx)
 
-    if len(unresolved_labels):
+    if len(ctx.unresolved):
         err("there were unresolved labels")
-        for l in sorted(unresolved_labels):
-            print(f"  @{l}")
+        for l, sources in sorted(ctx.unresolved.items()):
+            ids = ", ".join(sorted({f"{p.id} ({p.lang})" for p in sources}))
+            print(f"  @{l} in {ids}")
 
 # Finally, write out all resulting files to the _www folder. During the post-
 # processing step we apply a variable replacement scheme for {DOCGEN_*} to
 # modify the HTML (which we can't parse, it's not XML). This applies to raw
 # HTML blocks and thus most template code. It's not ideal but it works.
 
+DOCGEN_VARIABLES = ("DOCGEN_GLOBAL_STATIC", "DOCGEN_LOCAL_STATIC",
+                    "DOCGEN_ROOT", "DOCGEN_LANG", "DOCGEN_TITLE")
+DOCGEN_VARIABLES_REGEX = re.compile(
+    r'{{[ ]*(%s)[ ]*}}' % '|'.join(DOCGEN_VARIABLES))
+
 def tree_to_html(md, tree, variables):
     html = stdoc.stmarkdown.serialize_postprocess(md, tree)
-    regex = r'{{[ ]*(%s)[ ]*}}' % '|'.join(variables)
-    return re.sub(regex, lambda m: variables[m[1]], html)
+    if "{{" not in html:
+        return html
+    return DOCGEN_VARIABLES_REGEX.sub(lambda m: variables[m[1]], html)
 
 import jinja2
+import jinja2.meta
 
-def makeRefFunction(pages, p):
+# Templates often resolve the same labels repeatedly (eg. in navigation), so
+# results are memoized for each page.
+def makeRefFunction(ctx, p):
+    @functools.lru_cache(maxsize=None)
     def ref(label):
         assert label.startswith("@")
-        target, _ = resolve_label(pages, p, label[1:], p.lang)
+        target, _ = resolve_label(ctx, p, label[1:], p.lang)
         rp = p.relpath(target) if target is not None else None
         # print("<> from", p.url(), "target", label, "=", target, "->", rp)
         return rp
     return ref
 
-def generate_html(mainBundle, pages, md):
+# Jinja environment for a bundle, whose language table is used by the
+# `langcode` filter. Environments are kept around at module level so that
+# rendering the same bundle again doesn't recompile templates; compiled
+# templates are also cached on disk if a cache folder is specified.
+@functools.lru_cache(maxsize=32)
+def jinja_environment(bundle, templatePaths, cacheFolder):
+    bytecodeCache = None
+    if cacheFolder is not None:
+        bytecodeFolder = os.path.join(cacheFolder, "jinja")
+        recursive_mkdir(bytecodeFolder)
+        bytecodeCache = jinja2.FileSystemBytecodeCache(
+            directory=bytecodeFolder, pattern="%s.cache")
+    j = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(list(templatePaths)),
+        autoescape=jinja2.select_autoescape(),
+        keep_trailing_newline=True,
+        bytecode_cache=bytecodeCache,
+        auto_reload=False,
+        cache_size=-1)
+    j.filters["langcode"] = lambda code: bundle.config("languages")[code]
+    # j.filters["local"] = lambda text: "" if STRIP_HTML_SUFFIX else text
+    return j
+
+# Names of the context variables read by a template, including the templates
+# it extends, includes or imports. Returns None if this can't be determined
+# statically (eg. `{% include name %}` with a variable name), in which case
+# callers should provide every variable.
+@functools.lru_cache(maxsize=None)
+def template_variables(jenv, name):
+    names = set()
+    pending = [name]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source, _, _ = jenv.loader.get_source(jenv, name)
+        ast = jenv.parse(source)
+        names |= jinja2.meta.find_undeclared_variables(ast)
+        for sub in jinja2.meta.find_referenced_templates(ast):
+            if sub is None:
+                return None
+            pending.append(sub)
+    return frozenset(names)
+
+def generate_html(mainBundle, pages, ctx, md, cacheFolder=None):
     # One Jinja environment per bundle since the configuration may change.
     jenvs = dict()
     for b in mainBundle.iterBundles():
-        templatePaths = [os.path.join(parent._dir, "_templates")
-                         for parent in b.iterParents()]
-        j = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(templatePaths),
-            autoescape=jinja2.select_autoescape(),
-            keep_trailing_newline=True)
-        j.filters["langcode"] = lambda code: b.config("languages")[code]
-        # j.filters["local"] = lambda text: "" if STRIP_HTML_SUFFIX else text
-        jenvs[b] = j
+        templatePaths = tuple(os.path.join(parent._dir, "_templates")
+                              for parent in b.iterParents())
+        jenvs[b] = jinja_environment(b, templatePaths, cacheFolder)
+
+    # Available languages for each page ID, as (lang, url) pairs
+    languagesById = dict()
+    for p in pages.values():
+        languagesById.setdefault(p.id, []).append((p.lang, p.url()))
+    for variants in languagesById.values():
+        variants.sort()
+
+    # Create output folders beforehand, each only once
+    for folder in {os.path.dirname(p.output_path()) for p in pages.values()}:
+        recursive_mkdir(folder)
 
     total_written = 0
     for i, p in enumerate(pages.values()):
         path = p.output_path()
-        recursive_mkdir(os.path.dirname(path))
-
         print_nonl(f"[{i+1}/{len(pages)}] Writing out {path}...")
-        with open(path, "w") as fp:
-            variables = {
-                "DOCGEN_GLOBAL_STATIC": p.globalStaticRelpath(),
-                "DOCGEN_LOCAL_STATIC": p.localStaticRelpath(),
-                "DOCGEN_ROOT": p.relpath(Url("/")),
-                "DOCGEN_LANG": p.lang,
-                "DOCGEN_TITLE": p.title,
-            }
-
-            body = tree_to_html(md, p.tree, variables)
-            fragments = {
-                "DOCGEN_FRAGMENT_" + name: tree_to_html(md, frag, variables)
-                for name, frag in p.fragments.items() }
-
-            lang = sorted((i.lang, i.url()) for i in pages.values() if i.id == p.id)
-
-            template = jenvs[p.bundle].get_template(p.template)
-            html = template.render(
-                DOCGEN_ID = p.id,
-                DOCGEN_DOC = p,
-                DOCGEN_ARTICLE = body,
-                DOCGEN_LANG_AVAILABLE = lang,
-                ref = makeRefFunction(pages, p),
-                static = lambda path: p.relpath(p.localStaticUrl() / path),
-                global_static = lambda path: p.relpath(Url("/static") / path),
-                **variables,
-                **fragments)
-            fp.write(html)
+
+        variables = {
+            "DOCGEN_GLOBAL_STATIC": p.globalStaticRelpath(),
+            "DOCGEN_LOCAL_STATIC": p.localStaticRelpath(),
+            "DOCGEN_ROOT": p.relpath(Url("/")),
+            "DOCGEN_LANG": p.lang,
+            "DOCGEN_TITLE": p.title,
+        }
+
+        body = tree_to_html(md, p.tree, variables)
+
+        # Only serialize fragments that the template can actually display
+        jenv = jenvs[p.bundle]
+        used = template_variables(jenv, p.template)
+        fragments = dict()
+        for name, frag in p.fragments.items():
+            var = "DOCGEN_FRAGMENT_" + name
+            if used is None or var in used:
+                fragments[var] = tree_to_html(md, frag, variables)
+
+        # Static paths are used a lot in templates, make them cheap
+        localStatic = p.relpath(p.localStaticUrl())
+        globalStatic = p.relpath(Url("/static"))
+
+        template = jenv.get_template(p.template)
+        html = template.render(
+            DOCGEN_ID = p.id,
+            DOCGEN_DOC = p,
+            DOCGEN_ARTICLE = body,
+            DOCGEN_LANG_AVAILABLE = languagesById[p.id],
+            ref = makeRefFunction(ctx, p),
+            static = lambda path: f"{localStatic}/{path}",
+            global_static = lambda path: f"{globalStatic}/{path}",
+            **variables,
+            **fragments)
+        pathlib.Path(path).write_text(html, encoding="utf-8")
         total_written += 1
 
     print(f"Produced {total_written} pages")
 
-sys.exit(main(sys.argv))
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -13,9 +13,15 @@ URLs to all pages.
 """
 
 import os
+import re
+import sys
 import glob
 import yaml
+import pickle
+import hashlib
 import fnmatch
+import collections
+import concurrent.futures
 import stdoc.stmarkdown
 from enum import Enum
 from typing import Iterable, Union, Any
@@ -24,6 +30,9 @@ from dataclasses import dataclass, field
 from stdoc.pageinfo import *
 from stdoc.util import *
 
+# Use libyaml's loader when PyYAML was built with it, it's much faster
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # TODO: Internal flag to enable debugging the filesystem search
 _DEBUG_FSS = False
 
@@ -35,15 +44,9 @@ def filesystemSearch(dirpath: str, fss: dict[str, Any],
         if isinstance(x, str):
             return [x]
         return x
-    def splitAll(path: str) -> list[str]:
-        x, y = os.path.split(path)
-        if x == "" or y == "":
-            return [x + y]
-        return splitAll(x) + [y]
-    def debugPrint(*args, **kwargs):
+    def debugPrint(*args, sep=" ", **kwargs):
         if _DEBUG_FSS:
-            print("[fss] ", end="")
-            print(*args, **kwargs)
+            print("[fss] " + sep.join(map(str, args)), **kwargs)
 
     # First, find input globs from match_files or match_paths.
     matchGlobs = []
@@ -59,35 +62,46 @@ def filesystemSearch(dirpath: str, fss: dict[str, Any],
         candidates.update(glob.glob(mg, recursive=True))
 
     # Exclude anything that's captured by exclude patterns.
+    def compilePatterns(patterns: list[str]) -> list[tuple[str, re.Pattern]]:
+        return [(p, re.compile(fnmatch.translate(os.path.normcase(p))))
+                for p in patterns]
+    def firstMatch(patterns: list[tuple[str, re.Pattern]], name: str) \
+            -> str | None:
+        name = os.path.normcase(name)
+        return next((p for p, regex in patterns if regex.match(name)), None)
+
+    excludeFolders = compilePatterns(toStringList(fss.get("exclude_folders")))
+    excludeFiles = compilePatterns(toStringList(fss.get("exclude_files")))
+    ignorePrefixes = tuple(isp.rstrip("/") + "/" # FIXME
+                           for isp in ignoreSubpaths)
+
     matches = set()
     for c in candidates:
         assert c.startswith(dirpath + "/")
         c = c[len(dirpath)+1:]
-        comps = splitAll(c)
+        comps = c.split(os.sep)
         assert comps != []
-        keep = True
-        for ef in toStringList(fss.get("exclude_folders")):
-            if fnmatch.fnmatch(comps[0], ef):
-                debugPrint(f"ignoring {c} because exclude_folders {ef}")
-                keep = False
-        for ef in toStringList(fss.get("exclude_files")):
-            if fnmatch.fnmatch(comps[-1], ef):
-                debugPrint(f"ignoring {c} because exclude_files {ef}")
-                keep = False
-        for isp in ignoreSubpaths:
-            isp = isp.rstrip("/") + "/" # FIXME
-            if c.startswith(isp):
-                debugPrint(f"ignoring {c} because subfolder {isp}")
-                keep = False
-        if keep:
-            matches.add(c)
+        if (ef := firstMatch(excludeFolders, comps[0])) is not None:
+            debugPrint(f"ignoring {c} because exclude_folders {ef}")
+            continue
+        if (ef := firstMatch(excludeFiles, comps[-1])) is not None:
+            debugPrint(f"ignoring {c} because exclude_files {ef}")
+            continue
+        if c.startswith(ignorePrefixes):
+            debugPrint(f"ignoring {c} because of a sub-bundle")
+            continue
+        matches.add(c)
 
     debugPrint(f"({len(matches)}) {matches=}")
     return sorted(matches)
 
 class Bundle:
+    __slots__ = ("_dir", "_config", "_flat_config", "_subdirs", "_statics",
+                 "_parent", "_pages")
+
     _dir: str
     _config: dict[str, Any]
+    _flat_config: dict[tuple[str, ...], Any]
     _subdirs: dict[str, "Bundle"]
     _statics: list[str]
     _parent: Union[None, "Bundle"]
@@ -100,7 +114,7 @@ class Bundle:
            their exceptions separately) then added with `registerSubdir()`."""
         try:
             with open(os.path.join(dirpath, "stdoc.conf")) as fp:
-                self._config = yaml.safe_load(fp.read())
+                self._config = yaml.load(fp, Loader=_YamlLoader)
                 # Empty file
                 if self._config is None:
                     self._config = dict()
@@ -111,43 +125,52 @@ class Bundle:
         self._subdirs = dict()
         self._parent = None
         self._pages = None
+        self._flattenConfig()
 
-    def _log(self, *args, **kwargs):
-        print(style("[{}] ".format(self._dir), "m"), end="")
-        print(*args, **kwargs)
+    def _log(self, *args, sep=" ", **kwargs):
+        prefix = style("[{}] ".format(self._dir), "m")
+        print(prefix + sep.join(map(str, args)), **kwargs)
 
     def config(self, query: str = "", default: Any = None) -> Any:
         """Queries the config with a dot-path like "key.subkey.field". The
            default value is returned if the field or any parent is missing."""
-        def lookup(dic: dict[str, Any], fields: list[str], i: int) -> Any:
-            if i >= len(fields):
-                return (True, dic)
-            if fields[i] not in dic:
-                return (False, default)
-            return lookup(dic[fields[i]], fields, i+1)
-        def lookupInBundle(b: Bundle):
-            found, value = lookup(b._config, fields, 0)
-            if not found and b._parent is not None:
-                return lookupInBundle(b._parent)
-            return value
-        fields = query.split(".") if query else []
-        return lookupInBundle(self)
+        fields = tuple(query.split(".")) if query else ()
+        return self._flat_config.get(fields, default)
+
+    def _flattenConfig(self) -> None:
+        """Precomputes the value of every dot-path of the config, as a tuple
+           of fields, with fallback to the parent bundles' values. This must
+           be redone for the whole subtree when the parent chain changes."""
+        def flatten(value: Any, fields: tuple[str, ...]) -> None:
+            flat[fields] = value
+            if isinstance(value, dict):
+                for key, subvalue in value.items():
+                    flatten(subvalue, fields + (key,))
+        flat = dict(self._parent._flat_config) if self._parent else dict()
+        flatten(self._config, ())
+        self._flat_config = flat
+        for sb in self._subdirs.values():
+            sb._flattenConfig()
 
     def registerSubdir(self, subdir: str, bundle: "Bundle") -> None:
         """Registers a bundle loaded from a subfolder (at any depth)."""
         self._subdirs[subdir] = bundle
         bundle._parent = self
+        bundle._flattenConfig()
 
     def iterBundles(self) -> Iterable["Bundle"]:
         """Yields this bundle and all sub-bundles, recursively, depth-first."""
-        yield self
-        for sb in self._subdirs.values():
-            yield from sb.iterBundles()
+        stack = [self]
+        while stack:
+            b = stack.pop()
+            yield b
+            stack.extend(reversed(b._subdirs.values()))
 
     def iterParents(self) -> Iterable["Bundle"]:
-        yield self
-        if self._parent is not None:
-            yield from self._parent.iterParents()
+        b: Union[None, "Bundle"] = self
+        while b is not None:
+            yield b
+            b = b._parent
 
     def _findPages(self) -> list[str]:
         fss = self.config("inputs.pages")
@@ -199,7 +222,7 @@ class Bundle:
     def pagesRecursively(self) -> dict[str, PageInfo]:
         pages: dict[str, PageInfo] = dict()
         for b in self.iterBundles():
-            pages.update(**b.pages())
+            pages.update(b.pages())
         return pages
 
     def includeRoot(self) -> str:
@@ -234,49 +257,212 @@ def loadBundle(dirpath, recursive=False):
                 b.registerSubdir(subdirpath, sb)
     return b
 
-def initialParse(mainBundle, md):
-    allPages = mainBundle.pagesRecursively()
+def fileDigest(path: str) -> str | None:
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None
 
-    for i, (path, p) in enumerate(allPages.items()):
-        print_nonl(f"[{i+1}/{len(allPages)}] Parsing {path}...")
-        with open(path, "r") as fp:
-            source = fp.read()
+class ParseCache:
+    """On-disk cache of parsing results (see `stmarkdown.export_parse()`).
+       Entries are indexed by a hash of the source file and of everything else
+       that affects parsing. Files included by the source are only known after
+       parsing, so entries record their hashes and are discarded if any of them
+       has changed.
+
+       Recently used entries are also kept in memory (pickled, since imported
+       trees are modified afterwards) so that repeated builds in the same
+       process don't go back to the disk.
+
+       Entries not used during a run are deleted by `prune()` at the end of it,
+       so stale entries don't pile up. The cache can also be bypassed with
+       `--no-cache`, or reset by deleting its folder."""
+
+    _folder: str
+    # Names of the entry files used during this run
+    _used: set[str]
+
+    # In-memory LRU of pickled entries, shared by all instances
+    MEMORY_ENTRIES = 4096
+    _memory: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+
+    def __init__(self, folder: str):
+        self._folder = folder
+        self._used = set()
+        recursive_mkdir(folder)
+
+    def _remember(self, key: str, blob: bytes) -> None:
+        self._memory[key] = blob
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+    def key(self, source: str, includeRoot: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(stdoc.stmarkdown.config_fingerprint())
+        h.update(includeRoot.encode() + b"\0")
+        h.update(source.encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._folder, key + ".pkl")
+
+    def load(self, key: str) -> dict[str, Any] | None:
+        memoryKey = self._path(key)
+        self._used.add(key + ".pkl")
+        try:
+            blob = self._memory.get(memoryKey)
+            if blob is None:
+                with open(self._path(key), "rb") as fp:
+                    blob = fp.read()
+            entry = pickle.loads(blob)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            warn(f"{self._path(key)}: invalid cache entry ({e})")
+            return None
+        self._remember(memoryKey, blob)
+        for path, digest in entry["includes"]:
+            if fileDigest(path) != digest:
+                return None
+        return entry["data"]
+
+    def store(self, key: str, data: dict[str, Any], includes: list[str]) -> None:
+        entry = {
+            "includes": [(path, fileDigest(path)) for path in set(includes)],
+            "data": data,
+        }
+        blob = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        # Write to a temporary file first so entries are never truncated
+        path = self._path(key)
+        self._used.add(key + ".pkl")
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(blob)
+        os.replace(path + ".tmp", path)
+        self._remember(path, blob)
+
+    def prune(self) -> None:
+        """Deletes all entries that were not used since the cache was opened,
+           as well as leftover temporary files."""
+        for name in os.listdir(self._folder):
+            if name in self._used:
+                continue
+            path = os.path.join(self._folder, name)
+            self._memory.pop(path, None)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
+# Source files can be parsed in worker processes, each of which has its own
+# Markdown instance. Results are exported to be imported in the main instance.
+_workerMarkdown: stdoc.stmarkdown.Markdown | None = None
+
+def _initParseWorker():
+    global _workerMarkdown
+    _workerMarkdown = stdoc.stmarkdown.make_Markdown()
+
+def _parseInWorker(job: tuple[str, str]) -> tuple[dict[str, Any], list[str]]:
+    source, includeRoot = job
+    md = _workerMarkdown
+    assert md is not None, "parse worker was not initialized"
+    # Results are exported with their stash entries, no need to keep them
+    md.htmlStash.reset()
+    md.ext_include_root = includeRoot
+    tree = stdoc.stmarkdown.preprocess_parse_treeprocess(md, source)
+    return stdoc.stmarkdown.export_parse(md, tree, 0), md.ext_include_files
+
+def initialParse(mainBundle, md, cacheFolder=None, jobs=1):
+    allPages = mainBundle.pagesRecursively()
+    cache = None
+    if cacheFolder is not None:
+        cache = ParseCache(os.path.join(cacheFolder, "parse"))
+
+    # Read all sources and find the ones we already have in the cache
+    sources: dict[str, str] = dict()
+    keys: dict[str, str] = dict()
+    cached: dict[str, dict[str, Any]] = dict()
+    for path, p in allPages.items():
+        with open(path, "r") as fp:
+            sources[path] = fp.read()
         p.label_namespace = p.bundle.labelNamespace()
-        md.ext_include_root = p.bundle.includeRoot()
-        p.tree = stdoc.stmarkdown.preprocess_parse_treeprocess(md, source)
-        p.fragments = md.fragments
-
-        # Analyze the metadata block
-        fileLabels = []
-        for key, value in md.Meta.items():
-            if key == "title" and len(value) == 1:
-                p.title = value[0]
-            elif key == "url" and len(value) == 1:
-                url = value[0]
-                if url.endswith(".html"):
-                    print("{}: URL override {} should omit '.html' suffix" \
-                        .format(path, url))
-                    url = url[:-5]
-                if not url.startswith("/"):
-                    # TODO: Make URL override be relative to bundle
-                    url = "/" + url
-                p.url_override = Url(url)
-            elif key == "lang" and len(value) == 1:
-                p.lang = value[0]
-            elif key == "template" and len(value) == 1:
-                p.template = value[0]
-            elif key == "label":
-                assert all(v.startswith("@") for v in value)
-                fileLabels.extend(value)
-            elif key in ["bang-links", "bang-links-text"]:
-                pass
+        if cache:
+            keys[path] = cache.key(sources[path], p.bundle.includeRoot())
+            data = cache.load(keys[path])
+            if data is not None:
+                cached[path] = data
+
+    # Parse the other ones in parallel if there are enough of them. Results
+    # are consumed in page order so that the output doesn't depend on timing.
+    missing = [path for path in allPages if path not in cached]
+    executor = None
+    if jobs > 1 and len(missing) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(missing)),
+            initializer=_initParseWorker)
+        parsed = executor.map(_parseInWorker,
+            [(sources[path], allPages[path].bundle.includeRoot())
+             for path in missing])
+
+    try:
+        for i, (path, p) in enumerate(allPages.items()):
+            print_nonl(f"[{i+1}/{len(allPages)}] Parsing {path}...")
+            if path in cached:
+                p.tree = stdoc.stmarkdown.import_parse(md, cached[path])
+            elif executor is not None:
+                data, includes = next(parsed)
+                if cache:
+                    cache.store(keys[path], data, includes)
+                p.tree = stdoc.stmarkdown.import_parse(md, data)
             else:
-                warn(f"{path}: unknown metadata '{key}' of length {len(value)}")
+                stashStart = md.htmlStash.html_counter
+                md.ext_include_root = p.bundle.includeRoot()
+                p.tree = stdoc.stmarkdown.preprocess_parse_treeprocess(md,
+                    sources[path])
+                if cache:
+                    data = stdoc.stmarkdown.export_parse(md, p.tree, stashStart)
+                    cache.store(keys[path], data, md.ext_include_files)
+            p.fragments = md.fragments
+            analyzeMetadata(path, p, md.Meta)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if cache:
+        cache.prune()
+
+def analyzeMetadata(path: str, p: PageInfo, meta: dict[str, list[str]]) -> None:
+    # Analyze the metadata block
+    fileLabels = []
+    for key, value in meta.items():
+        if key == "title" and len(value) == 1:
+            p.title = value[0]
+        elif key == "url" and len(value) == 1:
+            url = value[0]
+            if url.endswith(".html"):
+                print("{}: URL override {} should omit '.html' suffix" \
+                    .format(path, url))
+                url = url[:-5]
+            if not url.startswith("/"):
+                # TODO: Make URL override be relative to bundle
+                url = "/" + url
+            p.url_override = Url(url)
+        elif key == "lang" and len(value) == 1:
+            p.lang = value[0]
+        elif key == "template" and len(value) == 1:
+            p.template = value[0]
+        elif key == "label":
+            assert all(v.startswith("@") for v in value)
+            fileLabels.extend(value)
+        elif key in ["bang-links", "bang-links-text"]:
+            pass
+        else:
+            warn(f"{path}: unknown metadata '{key}' of length {len(value)}")
 
-        # Collect labels
-        for l in fileLabels:
-            p.add_label(l[1:], p.url())
+    # Collect labels
+    for l in fileLabels:
+        p.add_label(l[1:], p.url())
 
 @dataclass
 class IDInfo:
@@ -294,8 +480,7 @@ class IDInfo:
     # All labels
     str_labels: str = ""
 
-    def __init__(self, bundle: Bundle, id: str):
-        pages = [p for p in bundle.pages().values() if p.id == id]
+    def __init__(self, bundle: Bundle, pages: list[PageInfo]):
         self.bundle = bundle
         self.pages = sorted(pages, key=lambda p: p.lang)
         self.lang = [p.lang for p in pages]
@@ -316,12 +501,11 @@ class IDInfo:
                 + url_components[0][1] + style(url_components[0][2], "wD")
         else:
             strs = []
-            for p in pages:
+            for p, comp in zip(pages, url_components):
                 if p.url_override is not None:
                     s = "{} ({})".format(style(str(p.url()),"y"),
                                          style(str(p.lang),"c"))
                 else:
-                    comp = p._url_components()
                     s = style(comp[0], "c") + comp[1] + style(comp[2], "wD")
                 strs.append(s)
             self.str_url = ", ".join(strs)
@@ -351,11 +535,14 @@ def summaryTable(mainBundle):
     idinfo = dict()
 
     for b in bundles:
-        ids = sorted({p.id for p in b.pages().values()})
+        pagesById: dict[str, list[PageInfo]] = dict()
+        for p in b.pages().values():
+            pagesById.setdefault(p.id, []).append(p)
+        ids = sorted(pagesById)
         for id in ids:
             # Ensure there is only one bundle using the ID
             assert id not in idinfo
-            idinfo[id] = IDInfo(b, id)
+            idinfo[id] = IDInfo(b, pagesById[id])
         nested = list(nest_paths_by_depth(ids))
         groups.append(nested)
 
@@ -375,12 +562,11 @@ def summaryTable(mainBundle):
                 sizes[3] = max(sizes[3], termlen(info.str_url))
                 sizes[4] = max(sizes[4], termlen(info.str_labels))
 
-    # Print table header
-    print("\x1b[47;30;1m ", end="")
-    print("   ".join(h.ljust(sz) for h, sz in zip(headings, sizes)), end="")
-    print(" \x1b[0m")
+    # Print table header, then the table, all in one write
+    out = ["\x1b[47;30;1m "
+           + "   ".join(h.ljust(sz) for h, sz in zip(headings, sizes))
+           + " \x1b[0m\n"]
 
-    # Print table
     for bundle, nested in zip(bundles, groups):
         firstLine = True
         for (depth, name, org) in nested:
@@ -396,11 +582,11 @@ def summaryTable(mainBundle):
                 url = info.str_url
                 labels = info.str_labels
 
-            print(" ", end="")
-            print(style(str_bundle.rjust(sizes[0]), "m"), end = " │ ")
-            print("  " * depth + style(name.ljust(sizes[1] - 2 * depth),
-                "bB" if org is None else ""), end=" │ ")
+            out.append(" " + style(str_bundle.rjust(sizes[0]), "m") + " │ "
+                + "  " * depth + style(name.ljust(sizes[1] - 2 * depth),
+                    "bB" if org is None else "") + " │ "
+                + termljust(lang, sizes[2]) + " │ "
+                + termljust(url, sizes[3]) + " │ "
+                + termljust(labels, sizes[4]) + " \n")
 
-            print(termljust(lang, sizes[2]), end=" │ ")
-            print(termljust(url, sizes[3]), end=" │ ")
-            print(termljust(labels, sizes[4]), end=" \n")
+    sys.stdout.write("".join(out))
@@ -9,13 +9,30 @@ Main data structure tracking metadata and relative paths for pages.
 
 import xml.etree.ElementTree as etree
 import dataclasses
+import functools
 import os
 import stdoc.collect # typing only
 from stdoc.util import *
-from typing import Tuple
+from typing import Tuple, Any
+
+# Memoizes a PageInfo method (by name and arguments) in the page's `_memo`.
+# URLs are used a lot during cross-referencing and rendering, so they are only
+# computed once. The memo is cleared when any field in _MEMO_FIELDS changes.
+def _memoized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(kwargs.items()))
+        if key not in self._memo:
+            self._memo[key] = method(self, *args, **kwargs)
+        return self._memo[key]
+    return wrapper
+
+# Fields that memoized methods depend on
+_MEMO_FIELDS = frozenset({"bundle", "id", "lang", "url_override",
+                          "local_static"})
 
 # Info for a single source file representing a generated page.
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PageInfo:
     # Bundle owning this page. This affects all config settings.
     bundle: "stdoc.collect.Bundle"
@@ -46,6 +63,16 @@ class PageInfo:
     tree: etree.Element | None = None
     fragments: dict[str, etree.Element] | None = None
 
+    # Memoized results of URL computations; see _memoized()
+    _memo: dict[tuple, Any] = dataclasses.field(default_factory=dict,
+        init=False, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        # _memo is not set yet while the constructor assigns fields
+        if name in _MEMO_FIELDS and hasattr(self, "_memo"):
+            self._memo.clear()
+        object.__setattr__(self, name, value)
+
     def config(self, query, default=None):
         return self.bundle.config(query, default)
 
@@ -53,6 +80,7 @@ class PageInfo:
     #   1: Language prefix, such as "/en", "/fr", or ""
     #   2: Path, which is just the ID prefixed with /, e.g. "/page"
     #   3: Suffix, which can be ".html", "index.html", or ""
+    @_memoized
     def _url_components(self, force_suffix: bool = False) -> \
             Tuple[str, str, str]:
         lang = "/" + self.lang if self.config("languages", False) else ""
@@ -78,12 +106,14 @@ class PageInfo:
             return url.addHtmlSuffix()
         return url
 
+    @_memoized
     def url(self) -> Url:
         if self.url_override:
             return self._overridden_url()
         else:
             return self._default_url(lang=True, suffix=True)
 
+    @_memoized
     def output_path(self) -> str:
         if self.url_override:
             url = self._overridden_url(force_suffix=True)
@@ -94,16 +124,34 @@ class PageInfo:
         assert s.endswith(".html")
         return os.path.join(self.config("outputs.folder", "_www"), s[1:])
 
-    # Relative path to other URL
+    # Relative path from the page's URL back to the root, e.g. "../.." for
+    # "/en/a/b.html", or "." for pages at the root. See Url._relpath().
+    @_memoized
+    def _root_relpath(self) -> str:
+        return Url("/") % self.url()
+
+    # Relative path to other URL. This is equivalent to `target % self.url()`
+    # but only prepends the memoized path to the root, since the structure of
+    # relative paths is always "../" to the root followed by the target.
     def relpath(self, target: Url) -> str:
-        return target % self.url()
+        t = str(target)
+        root = self._root_relpath()
+        if t == "/":
+            return root
+        # Same special cases as Url._relpath(): pages in the root folder and
+        # targets starting with "//" don't get the prefix
+        if t.startswith("//") or (root == "." and self.url()._depth == 1):
+            return t[1:]
+        return root + t
 
     def localStaticUrl(self) -> Url:
         return self.local_static
+    @_memoized
     def localStaticRelpath(self) -> str:
-        return self.localStaticUrl() % self.url()
+        return self.relpath(self.localStaticUrl())
+    @_memoized
     def globalStaticRelpath(self) -> str:
-        return Url("/static") % self.url()
+        return self.relpath(Url("/static"))
 
     # Add a label
     def add_label(self, name, target):
@@ -1,10 +1,20 @@
 from markdown import Markdown
+from markdown.util import HTML_PLACEHOLDER, HTML_PLACEHOLDER_RE
+from markdown.util import STX, AMP_SUBSTITUTE
+from markdown.postprocessors import RawHtmlPostprocessor
+from markdown.postprocessors import AndSubstitutePostprocessor
 from markdown.inlinepatterns import SubstituteTagPattern
 from markdown.inlinepatterns import InlineProcessor
 from markdown.extensions import Extension
 from markdown.extensions.codehilite import CodeHiliteExtension
 from markdown.extensions.toc import TocExtension
 import xml.etree.ElementTree as etree
+import functools
+import hashlib
+import markdown
+import pygments
+import glob
+import os
 
 from .ext_code import FencedCodeExtension
 from .ext_percent import PercentBlockCoreExtension, PercentBlockExtensionBase
@@ -42,39 +52,37 @@ class PercentTableExtension(PercentBlockExtensionBase):
         if class_:
             table.set("class", class_)
 
+        head_row = head in ["row", "rowcol"]
+        head_col = head in ["col", "rowcol"]
+        SubElement = etree.SubElement
+
         for i, row in enumerate(rows):
-            tr = etree.SubElement(table, "tr")
-            for j, text in enumerate(row.strip().split(colsep)):
-                cell_tag = "td"
-                if head in ["row", "rowcol"] and i == 0:
-                    cell_tag = "th"
-                if head in ["col", "rowcol"] and j == 0:
-                    cell_tag = "th"
-                cell = etree.SubElement(tr, cell_tag)
-                if text.strip():
+            tr = SubElement(table, "tr")
+            row_tag = "th" if head_row and i == 0 else "td"
+            for j, text in enumerate(row.split(colsep)):
+                cell = SubElement(tr, "th" if head_col and j == 0 else row_tag)
+                if text and not text.isspace():
                     parser.parseBlocks(cell, text.split("\u001d"))
 
+# Handles both label definitions (@=name) and references (@name) in a single
+# pattern, so text is only scanned once for labels.
 class LabelInlineProcessor(InlineProcessor):
     def handleMatch(self, m, data):
-        el = etree.Element("span")
-        el.set("id", m[1])
-        return el, m.start(0), m.end(0)
-
-class LabelReferenceInlineProcessor(InlineProcessor):
-    def handleMatch(self, m, data):
-        el = etree.Element("a")
-        el.set("href", m[0])
-        el.text = m[0]
+        if m[1] is not None:
+            el = etree.Element("span")
+            el.set("id", m[1])
+        else:
+            el = etree.Element("a")
+            el.set("href", m[0])
+            el.text = m[0]
         return el, m.start(0), m.end(0)
 
 class LabelsExtension(Extension):
     def extendMarkdown(self, md):
         md.registerExtension(self)
         # 125 is lower than links (170) so we don't substitue in URLs
-        LABEL_PATTERN = r'@=([a-zA-Z0-9._]+)'
-        md.inlinePatterns.register(LabelInlineProcessor(LABEL_PATTERN, md), "label-def", 125)
-        REF_PATTERN = r'@([a-zA-Z0-9_.:]*[a-zA-Z0-9._])'
-        md.inlinePatterns.register(LabelReferenceInlineProcessor(REF_PATTERN, md), "label-ref", 125)
+        LABEL_PATTERN = r'@(?:=([a-zA-Z0-9._]+)|([a-zA-Z0-9_.:]*[a-zA-Z0-9._]))'
+        md.inlinePatterns.register(LabelInlineProcessor(LABEL_PATTERN, md), "label", 125)
 
 class PercentFragmentExtension(PercentBlockExtensionBase):
     BLOCK_NAMES = ["fragment"]
@@ -95,16 +103,34 @@ class PercentCenterExtension(PercentBlockExtensionBase):
 # globally set a prefix for what "!!" should expand to. The prefix is taken
 # from document metadata.
 class BangLinksInlineProcessor(InlineProcessor):
+    def __init__(self, pattern, md):
+        super().__init__(pattern, md)
+        # Metadata that the patterns below were extracted from
+        self._meta = None
+        self._href_pattern = None
+        self._text_pattern = None
+
+    # Get the URL and text patterns from metadata; they're only looked up once
+    # per document (the meta preprocessor sets a new dict for each document).
+    def _patterns(self):
+        if self._meta is not self.md.Meta:
+            self._meta = self.md.Meta
+            self._href_pattern = None
+            if "bang-links" in self._meta:
+                self._href_pattern = self._meta["bang-links"][0]
+            self._text_pattern = self._meta.get("bang-links-text", ["{}"])[0]
+        return self._href_pattern, self._text_pattern
+
     def handleMatch(self, m, data):
-        if "bang-links" not in self.md.Meta:
+        href_pattern, text_pattern = self._patterns()
+        if href_pattern is None:
             el = etree.Element("span")
             el.set("style", "color: red")
             el.text = m[0]
         else:
             el = etree.Element("a")
-            el.set("href", self.md.Meta["bang-links"][0].replace("{}", m[1]))
+            el.set("href", href_pattern.replace("{}", m[1]))
             el.set("title", m[1])
-            text_pattern = self.md.Meta.get("bang-links-text", ["{}"])[0]
             el.text = text_pattern.replace("{}", m[1])
             # FIXME: Hack that should apply only to URLs
             if "{}" in text_pattern:
@@ -145,10 +171,24 @@ _md_ext = [
 def make_Markdown():
     return Markdown(options=_md_opt, extensions=_md_ext)
 
+# Fingerprint of everything that affects parsing besides the source itself:
+# library versions and the code of our own extensions.
+@functools.cache
+def config_fingerprint():
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{markdown.__version__} {pygments.__version__} {_md_opt}\0".encode())
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+        with open(path, "rb") as fp:
+            h.update(fp.read())
+    return h.digest()
+
 # This is a modified version of Markdown.convert split in two stages. First
 # stage does the preprocessing, block parsing, and tree processing.
 def preprocess_parse_treeprocess(md, source):
     md.fragments = dict()
+    md.ext_include_files = []
+    # Don't leak reference-style link definitions between documents
+    md.references.clear()
 
     # Split into lines and run the line preprocessors.
     md.lines = source.split("\n")
@@ -158,13 +198,17 @@ def preprocess_parse_treeprocess(md, source):
     # Parse the high-level elements.
     root = md.parser.parseDocument(md.lines).getroot()
 
-    # Run the tree-processors
-    for treeprocessor in md.treeprocessors:
+    # Run the tree-processors. Fragments are processed separately rather than
+    # under a common root, as the TOC extension would then number headings
+    # across fragments. The registry builds a new list on every iteration, so
+    # only do that once.
+    treeprocessors = list(md.treeprocessors)
+    for treeprocessor in treeprocessors:
         newRoot = treeprocessor.run(root)
         if newRoot is not None:
             root = newRoot
     for name, frag in md.fragments.items():
-        for treeprocessor in md.treeprocessors:
+        for treeprocessor in treeprocessors:
             newFrag = treeprocessor.run(frag)
             if newFrag is not None:
                 frag = newFrag
@@ -172,27 +216,83 @@ def preprocess_parse_treeprocess(md, source):
 
     return root
 
+# The result of the first stage can be exported to a picklable object and later
+# imported back into a Markdown instance (possibly a different one), which is
+# useful for caching. The trees refer to raw HTML stashed in the Markdown
+# instance by index, so the stash entries are exported along with the trees and
+# placeholders are renumbered during import.
+def export_parse(md, tree, stash_start):
+    return {
+        "tree": tree,
+        "fragments": md.fragments,
+        "meta": md.Meta,
+        "stash": md.htmlStash.rawHtmlBlocks[stash_start:],
+        "stash_start": stash_start,
+    }
+
+def import_parse(md, data):
+    offset = md.htmlStash.html_counter - data["stash_start"]
+    for html in data["stash"]:
+        md.htmlStash.store(html)
+
+    if offset != 0:
+        def shift(text):
+            if text is None or "\x02" not in text:
+                return text
+            return HTML_PLACEHOLDER_RE.sub(
+                lambda m: HTML_PLACEHOLDER % (int(m[1]) + offset), text)
+        def shift_tree(tree):
+            for el in tree.iter():
+                el.text = shift(el.text)
+                el.tail = shift(el.tail)
+                for key, value in el.attrib.items():
+                    el.set(key, shift(value))
+
+        shift_tree(data["tree"])
+        for frag in data["fragments"].values():
+            shift_tree(frag)
+        stash = md.htmlStash.rawHtmlBlocks
+        for i in range(len(stash) - len(data["stash"]), len(stash)):
+            if isinstance(stash[i], str):
+                stash[i] = shift(stash[i])
+            else:
+                shift_tree(stash[i])
+
+    md.fragments = data["fragments"]
+    md.Meta = data["meta"]
+    return data["tree"]
+
+# Postprocessors that only substitute occurrences of a marker string, along with
+# that marker. They are skipped when the marker doesn't appear in the output.
+# Notably the raw HTML postprocessor would otherwise run a regex over every page
+# since the stash is shared between all pages.
+_postprocessor_markers = [
+    (RawHtmlPostprocessor, STX),
+    (AndSubstitutePostprocessor, AMP_SUBSTITUTE),
+]
+
 # After we connect documents together, second stage does the serialization and
 # the postprocessing.
 def serialize_postprocess(md, tree):
-    # Serialize _properly_.  Strip top-level tags.
-    output = md.serializer(tree)
+    # Serialize _properly_. This has to be Markdown's serializer and not
+    # ElementTree's (faster) C serializer, which differs on entities, attribute
+    # order and empty elements. Strip top-level tags by serializing the root as
+    # a tag-less node (which only outputs its contents) instead of searching
+    # for them in the output.
     if md.stripTopLevelTags:
+        tag, tree.tag = tree.tag, None
         try:
-            start = output.index('<%s>' % md.doc_tag) + len(md.doc_tag) + 2
-            end = output.rindex('</%s>' % md.doc_tag)
-            output = output[start:end].strip()
-        except ValueError as e:
-            if output.strip().endswith('<%s />' % md.doc_tag):
-                # We have an empty document
-                output = ''
-            else:
-                # We have a serious problem
-                raise ValueError('Markdown failed to strip top-level '
-                                 'tags. Document=%r' % output.strip()) from e
+            output = md.serializer(tree).strip()
+        finally:
+            tree.tag = tag
+    else:
+        output = md.serializer(tree)
 
     # Run the text post-processors
     for pp in md.postprocessors:
+        if any(isinstance(pp, cls) and marker not in output
+               for cls, marker in _postprocessor_markers):
+            continue
         output = pp.run(output)
 
     return output.strip()
@@ -13,6 +13,7 @@ from markdown.extensions import Extension
 from markdown.extensions.attr_list import get_attrs_and_remainder
 from markdown.extensions.codehilite import CodeHilite, parse_hl_lines
 from typing import Tuple, Any
+import functools
 import re
 
 class FencedCodeExtension(Extension):
@@ -24,8 +25,50 @@ class FencedCodeExtension(Extension):
         md.registerExtension(self)
         md.preprocessors.register(FencedBlockPreprocessor(md, self.hilite_conf), 'fenced_code_block', 25)
 
+# Highlighting is the main cost of code blocks, and identical snippets are
+# common, so results are cached. `config` is a tuple of (key, value) pairs with
+# hashable values.
+@functools.lru_cache(maxsize=2048)
+def _hilite(code, lang, config):
+    local_config = dict(config)
+    highliter = CodeHilite(code,
+        lang=lang,
+        style=local_config.pop('pygments_style', 'default'),
+        **local_config)
+    return highliter.hilite(shebang=False)
+
+def handle_attrs(attrs) -> Tuple[str, tuple[str, ...], dict[str, Any]]:
+    id = ''
+    classes = []
+    configs: dict[str, Any] = {}
+    for k, v in attrs:
+        if k == 'id':
+            id = v
+        elif k == '.':
+            classes.append(v)
+        elif k == 'hl_lines':
+            configs[k] = parse_hl_lines(v)
+        elif k == 'linenums':
+            configs[k] = True
+        else:
+            configs[k] = v
+    return id, tuple(classes), configs
+
+# Attributes of a fence line as (id, classes, config). The same attributes
+# (eg. "c linenums") are used over and over so results are cached; they are
+# shared and must not be modified.
+@functools.lru_cache(maxsize=256)
+def parse_fence_attrs(attr_str) -> Tuple[str, tuple[str, ...], dict[str, Any]]:
+    return handle_attrs(get_attrs_and_remainder(attr_str)[0])
+
 class FencedBlockPreprocessor(Preprocessor):
-    RE_FENCE = re.compile(r'(`{3,})[ ]*([\w#.+-]*)[ ]*([^\n]*)')
+    @functools.cached_property
+    def RE_FENCE(self):
+        return re.compile(r'(`{3,})[ ]*([\w#.+-]*)[ ]*([^\n]*)')
+    # Start of lines that may open a fence, searched in the joined document
+    @functools.cached_property
+    def RE_FENCE_START(self):
+        return re.compile(r'^```', re.MULTILINE)
 
     def __init__(self, md, hilite_conf):
         super().__init__(md)
@@ -36,10 +79,11 @@ class FencedBlockPreprocessor(Preprocessor):
         start_index = index
         if not m:
             return index+1, (None, None, None, None, None)
-        index += 1
-        while index < len(lines) and lines[index] != m[1]:
-            index += 1
-        id, classes, config = self.handle_attrs(get_attrs_and_remainder(m[3])[0])
+        try:
+            index = lines.index(m[1], index+1)
+        except ValueError:
+            index = len(lines)
+        id, classes, config = parse_fence_attrs(m[3])
         code = "\n".join(lines[start_index+1:index])
         return index+1, (m[2], id, classes, config, code)
 
@@ -47,15 +91,25 @@ class FencedBlockPreprocessor(Preprocessor):
         out_lines = []
         index = 0
 
-        while index < len(lines):
+        # Only look at lines that start with a fence instead of matching every
+        # line; line numbers are recovered by counting newlines in-between.
+        text = "\n".join(lines)
+        line, line_pos = 0, 0
+        for fm in self.RE_FENCE_START.finditer(text):
+            line += text.count("\n", line_pos, fm.start())
+            line_pos = fm.start()
+            # Skip fences within code blocks that were already consumed
+            if line < index:
+                continue
+
             # Is there a fenced block at the current line?
-            next_index, (lang, id, classes, config, code) = self.match_fence(lines, index)
+            next_index, (lang, id, classes, config, code) = self.match_fence(lines, line)
             if classes is None:
                 classes = []
             if code is None:
-                out_lines.append(lines[index])
-                index += 1
                 continue
+            out_lines.extend(lines[index:line])
+            index = line
             # print(f"Fenced block at line {index}: lang {repr(lang)}, id {repr(id)}, classes {classes}, config {config}, {next_index-index-2} lines of code")
 
             # Add syntax-<lang> class if <lang> is specified
@@ -69,30 +123,12 @@ class FencedBlockPreprocessor(Preprocessor):
                 # Pygments adds a suffix so we get "codehilitetable"
                 "cssclass": classes + " codehilite" }
 
-            highliter = CodeHilite(code,
-                lang=lang,
-                style=local_config.pop('pygments_style', 'default'),
-                **local_config)
-
-            code = highliter.hilite(shebang=False)
+            config_key = tuple(sorted(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in local_config.items()))
+            code = _hilite(code, lang, config_key)
             out_lines.append(self.md.htmlStash.store(code))
             index = next_index
 
+        out_lines.extend(lines[index:])
         return out_lines
-
-    def handle_attrs(self, attrs) -> Tuple[str, list[str], dict[str, Any]]:
-        id = ''
-        classes = []
-        configs: dict[str, Any] = {}
-        for k, v in attrs:
-            if k == 'id':
-                id = v
-            elif k == '.':
-                classes.append(v)
-            elif k == 'hl_lines':
-                configs[k] = parse_hl_lines(v)
-            elif k == 'linenums':
-                configs[k] = True
-            else:
-                configs[k] = v
-        return id, classes, configs
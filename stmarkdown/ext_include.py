@@ -3,13 +3,15 @@ ext_include: An extension for including other files verbatim
 
 Pretty much like the C preprocessor. `..include "sth.md"` will include. A field
 `.ext_include_root` can be set on the Markdown instance to control where we
-include from.
+include from. If the field `.ext_include_files` is a list, the paths of all
+included files are appended to it.
 """
 
 from markdown.preprocessors import Preprocessor
 from markdown.extensions import Extension
 from markdown.extensions.codehilite import parse_hl_lines
 from typing import Tuple, Any
+import functools
 import re
 import os
 
@@ -21,20 +23,79 @@ class IncludeExtension(Extension):
         md.registerExtension(self)
         md.preprocessors.register(IncludePreprocessor(md), 'include', 25)
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
 class IncludePreprocessor(Preprocessor):
-    RE_INCLUDE = re.compile(r'^\.\.include[ ]*\"([^"]+)\"[ ]*$')
+    @functools.cached_property
+    def RE_INCLUDE(self):
+        return re.compile(r'^\.\.include[ ]*\"([^"]+)\"[ ]*$')
+
+    def __init__(self, md):
+        super().__init__(md)
+        # Flattened contents of included files by path, as pairs (deps, lines)
+        # where deps lists (path, mtime) for the file and its nested includes.
+        # Files are often included by many pages, so they're only read again
+        # if one of them changes.
+        self.cache = dict()
 
     def run(self, lines):
         root = getattr(self.md, "ext_include_root", "")
+        deps = []
+        out_lines = self.expand(lines, root, deps)
+        included = getattr(self.md, "ext_include_files", None)
+        if included is not None:
+            included.extend(path for path, _ in deps)
+        return out_lines
+
+    # Expands includes in `lines`, adding the (path, mtime) of all included
+    # files to `deps`. Nested includes are handled with an explicit stack of
+    # files being expanded, as tuples (path, deps, remaining lines, output).
+    def expand(self, lines, root, deps):
         out_lines = []
-        for l in lines:
-            m = self.RE_INCLUDE.match(l)
-            if m is not None:
-                path = os.path.join(root, m[1])
-                with open(path, "r") as fp:
-                    out_lines.extend(self.run(fp.read().splitlines()))
+        stack = [(None, deps, iter(lines), out_lines)]
+        active = []
+
+        while stack:
+            path, file_deps, it, out = stack[-1]
+            for l in it:
+                m = None
+                if l.startswith("..include"):
+                    m = self.RE_INCLUDE.match(l)
+                if m is None:
+                    out.append(l)
+                    continue
+
+                sub = os.path.join(root, m[1])
+                entry = self.cache.get(sub)
+                if entry is not None and \
+                        all(_mtime(p) == t for p, t in entry[0]):
+                    file_deps.extend(entry[0])
+                    out.extend(entry[1])
+                    continue
+
+                real = os.path.realpath(sub)
+                if real in active:
+                    chain = [s[0] for s in stack[1:]] + [sub]
+                    raise Exception("include cycle: " + " -> ".join(chain))
+                sub_deps = [(sub, _mtime(sub))]
+                with open(sub, "r") as fp:
+                    sub_lines = fp.read().splitlines()
+                active.append(real)
+                stack.append((sub, sub_deps, iter(sub_lines), []))
+                break
             else:
-                out_lines.append(l)
+                # Done with this file; cache it and add it to the includer
+                stack.pop()
+                if path is not None:
+                    active.pop()
+                    self.cache[path] = (file_deps, out)
+                    stack[-1][1].extend(file_deps)
+                    stack[-1][3].extend(out)
+
         return out_lines
 
     def handle_attrs(self, attrs) -> Tuple[str, list[str], dict[str, Any]]:
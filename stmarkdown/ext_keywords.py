@@ -21,10 +21,11 @@ class KeywordsInlineProcessor(InlineProcessor):
         self.keywords = keywords
 
     def handleMatch(self, m, data):
-        el = etree.Element("span")
-        if not m[0] in self.keywords:
+        class_ = self.keywords.get(m[0])
+        if class_ is None:
             raise Exception(f"internal error: matched wrong keyword {m[0]}")
-        el.set("class", self.keywords[m[0]])
+        el = etree.Element("span")
+        el.set("class", class_)
         el.text = m[0]
         return el, m.start(0), m.end(0)
 
@@ -35,5 +36,8 @@ class KeywordsExtension(Extension):
 
     def extendMarkdown(self, md):
         md.registerExtension(self)
-        pattern = r'|'.join(re.escape(k) for k in self.keywords.keys())
+        # Longest keywords first so that a keyword is never matched instead of
+        # a longer one it is a prefix of
+        keywords = sorted(self.keywords, key=len, reverse=True)
+        pattern = r'(?:' + r'|'.join(re.escape(k) for k in keywords) + r')'
         md.inlinePatterns.register(KeywordsInlineProcessor(pattern, md, self.keywords), "keywords", 175)
@@ -9,11 +9,26 @@ TODO: Document the percent block processor.
 
 from markdown.blockprocessors import BlockProcessor
 from markdown.extensions import Extension
+import functools
 import re
 
+# Position of the first line of `text` equal to `line`, or -1 if there is none.
+def find_line(text, line):
+    if text.startswith(line) and (len(text) == len(line)
+                                  or text[len(line)] == "\n"):
+        return 0
+    i = text.find("\n" + line + "\n")
+    if i < 0 and text.endswith("\n" + line):
+        i = len(text) - len(line) - 1
+    return i + 1 if i >= 0 else -1
+
 class PercentBlockProcessor(BlockProcessor):
-    RE_INTRO = re.compile(r'^(%+)(\w[\w_.-]*)[ ]*(?:\(([^\n]+)\))?[ ]*(?:\n|(%)$)', re.MULTILINE)
-    RE_PARAM = re.compile(r'([a-z]+)=(?:([^\s"]+)|"((?:[^"]|\\")*)")(?=\s|$)')
+    @functools.cached_property
+    def RE_INTRO(self):
+        return re.compile(r'^(%+)(\w[\w_.-]*)[ ]*(?:\(([^\n]+)\))?[ ]*(?:\n|(%)$)', re.MULTILINE | re.ASCII)
+    @functools.cached_property
+    def RE_PARAM(self):
+        return re.compile(r'([a-z]+)=(?:([^\s"]+)|"((?:[^"]|\\")*)")(?=\s|$)')
 
     def __init__(self, md):
         super().__init__(md)
@@ -25,7 +40,8 @@ class PercentBlockProcessor(BlockProcessor):
         self.block_types[name] = handler
 
     def test(self, parent, block):
-        return self.RE_INTRO.match(block)
+        # This runs on every block, most of which are obviously not %-blocks
+        return block.startswith("%") and self.RE_INTRO.match(block)
 
     def run(self, parent, blocks):
         m = self.RE_INTRO.match(blocks[0])
@@ -40,15 +56,15 @@ class PercentBlockProcessor(BlockProcessor):
         content_blocks = []
         i = 0
         while m[4] is None and i < len(blocks):
-            lines = blocks[i].split("\n")
-            if delimiter in lines:
-                delimiter_index = lines.index(delimiter)
-                content_blocks.append("\n".join(lines[:delimiter_index]))
-                blocks[i] = "\n".join(lines[delimiter_index+1:])
+            end = find_line(blocks[i], delimiter)
+            if end >= 0:
+                content_blocks.append(blocks[i][:max(end-1, 0)])
+                blocks[i] = blocks[i][end+len(delimiter)+1:]
                 break
-            else:
-                content_blocks.append(blocks[i])
-                del blocks[i]
+            content_blocks.append(blocks[i])
+            i += 1
+        # Remove consumed blocks all at once
+        del blocks[:i]
 
         # print(f"Percent block: type {name}, params {params}")
         if name not in self.block_types:
@@ -5,22 +5,44 @@ ext_register: A %-block extension for writing peripheral registers
 from .ext_percent import PercentBlockExtensionBase
 import xml.etree.ElementTree as etree
 import textwrap
+import functools
 import re
 
-def colon_parse(text):
-    RE_HEADER = re.compile(r'^(\S[^\n]*[^\\]):\s*$', re.MULTILINE)
+# Lines ending with an unescaped colon are headers
+@functools.cache
+def re_header():
+    return re.compile(r'^(\S[^\n]*[^\\]):\s*$', re.MULTILINE)
+
+# Yields the non-empty text between headers and the headers themselves, in
+# order and stripped.
+def colon_segments(text):
+    last_end = 0
+    for m in re_header().finditer(text):
+        for segment in (text[last_end:m.start()], m[1]):
+            segment = segment.strip()
+            if segment:
+                yield segment
+        last_end = m.end()
+    segment = text[last_end:].strip()
+    if segment:
+        yield segment
 
-    # Split into lines, each line ending with an unescaped colon is a group
-    groups = re.split(RE_HEADER, text)
-    groups = [ x.strip() for x in groups if x.strip() ]
-    register, bits, *fields = groups
+def colon_parse(text):
+    groups = colon_segments(text)
+    register = next(groups, None)
+    bits = next(groups, None)
+    if bits is None:
+        raise ValueError("register needs a header and a list of bits")
 
     # Group the field descriptions in pairs
-    fields2 = { fields[i]: fields[i+1] for i in range(0, len(fields), 2) }
+    fields = list(groups)
+    if len(fields) % 2:
+        raise ValueError(f"register field '{fields[-1]}' has no description")
+    fields2 = dict(zip(fields[::2], fields[1::2]))
 
     # Parse bits
-    bits = [ attr.strip().split(":") for attr in bits.split("\n") ]
-    bits = { attr[0]: attr[1].strip() for attr in bits }
+    bits = { name: spec.strip() for name, _, spec in
+             (attr.strip().partition(":") for attr in bits.split("\n")) }
 
     return register, bits, fields2
 
@@ -41,6 +63,11 @@ class Spec:
     def __repr__(self):
         return f"<'{self.name}' {self.mode} ={self.default}>"
 
+# Bit intervals, such as "7" or "31-24"
+@functools.cache
+def re_interval():
+    return re.compile(r'\d+(?:-\d+)?')
+
 class Register:
     def __init__(self, header, bits, fields):
         name, size = header.split()
@@ -62,18 +89,20 @@ class Register:
                 if start > end:
                     start, end = end, start
                 return (start, end - start + 1)
-        def start(e):
-            return interval(e)[0]
-        def length(e):
-            return interval(e)[1]
-        def interval_or_name(f):
-            try:
-                return interval(f)
-            except:
-                return f
-
-        bits = { start(e): (length(e), bits[e]) for e in bits }
-        fields = { interval_or_name(f): fields[f] for f in fields }
+        def is_interval(e):
+            return re_interval().fullmatch(e) is not None
+
+        bits = { start: (length, bits[e])
+                 for e in bits for start, length in [interval(e)] }
+
+        # Field descriptions can refer to either an interval or a name
+        fields_by_interval = dict()
+        fields_by_name = dict()
+        for f, descr in fields.items():
+            if is_interval(f):
+                fields_by_interval[interval(f)] = descr
+            else:
+                fields_by_name[f] = descr
 
         # Fill in intervals that are taken from either [default] or [bits]
         self.intervals = []
@@ -96,14 +125,12 @@ class Register:
                 spec = Spec(bits[b][1])
 
                 # Check if there is a field description
-                descr = ""
-                for f in fields:
-                    if f == (b, length2) or f == spec.name:
-                        descr = fields[f]
-                        break
+                descr = fields_by_interval.get((b, length2))
+                if descr is None:
+                    descr = fields_by_name.get(spec.name, "")
 
-                self.intervals.append((length2, Spec(bits[b][1]), descr))
-                b += bits[b][0]
+                self.intervals.append((length2, spec, descr))
+                b += length2
 
         self.intervals = list(reversed(self.intervals))
 
@@ -120,38 +147,43 @@ class Register:
         table = etree.Element("table")
         table.set("class", "register-diagram")
 
-        bitnos = etree.SubElement(table, "tr")
+        SubElement = etree.SubElement
+        bitnos = SubElement(table, "tr")
+        names = SubElement(table, "tr")
+        initial = SubElement(table, "tr")
+        modes = SubElement(table, "tr")
+
         for i in reversed(range(self.size)):
-            td = etree.SubElement(bitnos, "td")
+            td = SubElement(bitnos, "td")
             td.text = str(i)
 
-        names = etree.SubElement(table, "tr")
+        # Per-bit contents of the initial value and mode rows
+        initial_texts = []
+        mode_texts = []
+
         for bits, spec, descr in self.intervals:
-            td = etree.SubElement(names, "td")
+            td = SubElement(names, "td")
             td.text = spec.name
             if spec.name == "":
                 td.set("class", "nothing")
             td.set("colspan", str(bits))
 
-        initial = etree.SubElement(table, "tr")
-        for bits, spec, descr in self.intervals:
-            default = spec.default
-            while len(default) < bits:
-                default += spec.default
-            for i in range(bits):
-                td = etree.SubElement(initial, "td")
-                td.text = default[i]
-                if default[i] == "0" and not spec.name:
-                    td.text = ""
-
-        modes = etree.SubElement(table, "tr")
-        for bits, spec, descr in self.intervals:
+            # Repeat the default value pattern over all bits
+            default = (spec.default * bits)[:bits] or [""] * bits
+            if spec.name:
+                initial_texts.extend(default)
+            else:
+                initial_texts.extend("" if c == "0" else c for c in default)
+
             mode = spec.mode
             if mode == "R" and not spec.name:
                 mode = ""
-            for i in range(bits):
-                td = etree.SubElement(modes, "td")
-                td.text = mode
+            mode_texts += [mode] * bits
+
+        for text in initial_texts:
+            SubElement(initial, "td").text = text
+        for text in mode_texts:
+            SubElement(modes, "td").text = text
 
         return table
 
@@ -161,8 +193,8 @@ class Register:
         if self.wide:
             table.set("class", table.get("class", "") + " wide")
         header = etree.SubElement(table, "tr")
-        for h in ["Bits", "Name", "RW", "Init", "Description"]:
-            th = etree.SubElement(header, "th")
+        header.extend(etree.Element("th") for _ in range(5))
+        for th, h in zip(header, ["Bits", "Name", "RW", "Init", "Description"]):
             if h == "RW":
                 code = etree.SubElement(th, "code")
                 code.text = h
@@ -176,11 +208,9 @@ class Register:
                 continue
 
             tr = etree.SubElement(table, "tr")
-            td_bits  = etree.SubElement(tr, "td")
-            td_name  = etree.SubElement(tr, "td")
-            td_mode  = etree.SubElement(tr, "td")
-            td_init  = etree.SubElement(tr, "td")
-            td_descr = etree.SubElement(tr, "td")
+            cells = [etree.Element("td") for _ in range(5)]
+            tr.extend(cells)
+            td_bits, td_name, td_mode, td_init, td_descr = cells
 
             if bits == 1:
                 td_bits.text = str(position)
@@ -0,0 +1,27 @@
+import tempfile
+import unittest
+
+from stdoc.collect import Bundle
+from stdoc.pageinfo import PageInfo
+from stdoc.util import Url
+
+class RelpathTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        with open(self.dir.name + "/stdoc.conf", "w"):
+            pass
+        self.bundle = Bundle(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_same_as_url(self):
+        # PageInfo.relpath() must be equivalent to `target % page.url()`
+        for url in ["/a", "/a/b", "/a/b/c", "/a/..", "/a/../b", "/a//b"]:
+            p = PageInfo(self.bundle, "page", "en", url_override=Url(url))
+            for target in ["/", "/x", "/x/y", "//x", "/x//y"]:
+                self.assertEqual(p.relpath(Url(target)),
+                                 Url(target) % p.url(), f"{target} % {url}")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+from stdoc.stmarkdown.ext_register import colon_parse
+
+class ColonParseTest(unittest.TestCase):
+    def test_fields(self):
+        register, bits, fields = colon_parse(
+            "REG u8:\n  7-4: HI RW =0\n  0: LO R =1\nHI:\n  High.\nLO:\n  Low.")
+        self.assertEqual(register, "REG u8")
+        self.assertEqual(bits, {"7-4": "HI RW =0", "0": "LO R =1"})
+        self.assertEqual(fields, {"HI": "High.", "LO": "Low."})
+
+    def test_unpaired_field_header(self):
+        with self.assertRaisesRegex(ValueError,
+                r"^register field 'LO' has no description$"):
+            colon_parse("REG u8:\n  7-4: HI RW =0\nHI:\n  High.\nLO:")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+import stdoc.stmarkdown
+
+class ReferenceLinksTest(unittest.TestCase):
+    def links(self, md, source):
+        tree = stdoc.stmarkdown.preprocess_parse_treeprocess(md, source)
+        return [a.get("href") for a in tree.iter("a")]
+
+    def test_definitions_are_per_document(self):
+        md = stdoc.stmarkdown.make_Markdown()
+        self.assertEqual(
+            self.links(md, "[x][ref]\n\n[ref]: https://example.com"),
+            ["https://example.com"])
+        # Definitions from the previous document don't carry over
+        self.assertEqual(self.links(md, "[x][ref]"), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import unittest
+
+from stdoc.util import Url
+
+class RelpathTest(unittest.TestCase):
+    def test_root(self):
+        self.assertEqual(Url("/") % Url("/a/b/c"), "../..")
+        self.assertEqual(Url("/") % Url("/a"), ".")
+
+    def test_matches_os_path(self):
+        for base in ["/a/b", "/a/b/c", "/a//b/c", "/a/./b"]:
+            for target in ["/x", "/x/y", "/x//y", "//x", "//x/y"]:
+                expected = os.path.join(
+                    os.path.relpath("/", os.path.dirname(base)), target[1:])
+                self.assertEqual(Url(target) % Url(base), expected,
+                                 f"{target} % {base}")
+
+    def test_repeated_separators(self):
+        # Targets starting with "//" are not prefixed with the path to the root
+        self.assertEqual(Url("//x") % Url("/a/b/c"), "/x")
+        self.assertEqual(Url("/x//y") % Url("/a/b/c"), "../../x//y")
+        self.assertEqual(Url("/x") % Url("/a//b/c"), "../../x")
+
+    def test_join(self):
+        self.assertEqual(str(Url("/a") / "b//c"), "/a/b//c")
+        self.assertEqual(str(Url("/a") / "/b"), "/b")
+        self.assertEqual(str(Url("/") / "b"), "/b")
+
+if __name__ == "__main__":
+    unittest.main()
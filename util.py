@@ -8,63 +8,134 @@ Utility functions independent of any application logic.
 """
 
 from typing import Iterable, Any
+import functools
+import tempfile
+import shutil
+import errno
 import sys
 import os
+import re
+import weakref
 
-def print_nonl(*args, **kwargs):
-    print(*args, **kwargs, end="")
+# Whether stdout is a terminal; progress messages are only overwritten then
+_IS_TTY = sys.stdout is not None and sys.stdout.isatty()
+
+def print_nonl(*args, sep=" "):
+    msg = sep.join(map(str, args))
+    if not _IS_TTY:
+        sys.stdout.write(msg + "\n")
+        return
+    sys.stdout.write(msg)
     sys.stdout.flush()
+    # Clear the line when the next message is printed. This bypasses the text
+    # layer, which would flush immediately because of the "\r".
     sys.stdout.buffer.write(b"\r\x1b[K")
 
-def warn(*args, **kwargs):
-    print("\x1b[33mwarning:\x1b[0m ", end="")
-    print(*args, **kwargs)
+def warn(*args, sep=" ", **kwargs):
+    print("\x1b[33mwarning:\x1b[0m " + sep.join(map(str, args)), **kwargs)
 
-def err(*args, **kwargs):
-    print("\x1b[31merror:\x1b[0m ", end="")
-    print(*args, **kwargs)
+def err(*args, sep=" ", **kwargs):
+    print("\x1b[31merror:\x1b[0m " + sep.join(map(str, args)), **kwargs)
 
 def print_with_guard(s: str, guard: str) -> None:
-    lines = s.splitlines()
-    print("\n".join(guard + s for s in lines))
+    if not s:
+        print()
+        return
+    if s.endswith("\n"):
+        s = s[:-1]
+    print(guard + s.replace("\n", "\n" + guard))
+
+# SGR codes for each letter of a style spec
+_STYLE_CODES: dict[str, str] = {
+    "B": "1", "D": "2", "I": "3", "U": "4",
+    "k": "30", "r": "31", "g": "32", "y": "33", "b": "34", "m": "35",
+    "c": "36",
+}
+
+# Escape sequence setting all the styles of a spec at once (eg. "Br" gives
+# "\x1b[1;31m"), or "" if there are none. Specs are a few letters long, for
+# which a plain list comprehension beats str.translate() (which also needs
+# unknown letters filtered out first), and results are cached anyway.
+@functools.lru_cache(maxsize=256)
+def _style_prefix(style_spec: str) -> str:
+    codes = [_STYLE_CODES[c] for c in style_spec if c in _STYLE_CODES]
+    return "\x1b[" + ";".join(codes) + "m" if codes else ""
 
 def style(s: str, style_spec: str) -> str:
-    if not style_spec:
+    prefix = _style_prefix(style_spec) if style_spec else ""
+    if not prefix:
         return s
-    styles = {
-        "B": "1", "D": "2", "I": "3", "U": "4",
-        "k": "30", "r": "31", "g": "32", "y": "33", "b": "34", "m": "35",
-        "c": "36",
-    }
-    before = ""
-    for c in style_spec:
-        if c in styles:
-            before += "\x1b[" + styles[c] + "m"
-
-    return before + s + "\x1b[0m"
+    return prefix + s + "\x1b[0m"
+
+# Escape sequences, from ESC to the next "m" (or the end of the string)
+_ESCAPE_RE = re.compile(r"\x1b[^m]*m?")
 
 def termlen(s: str) -> int:
-    l = 0
-    in_escape = False
-    for c in s:
-        if c == "\x1b":
-            in_escape = True
-        l += not in_escape
-        if in_escape and c == "m":
-            in_escape = False
-    return l
+    # Most strings are unstyled; "in" scans them without going through re
+    if "\x1b" not in s:
+        return len(s)
+    return len(_ESCAPE_RE.sub("", s))
 
 def termljust(s: str, n: int) -> str:
-    return s.ljust(n + len(s) - termlen(s))
+    visible = termlen(s)
+    return s if visible >= n else s + " " * (n - visible)
 
 def recursive_mkdir(fpath: str) -> None:
-    if not fpath or os.path.exists(fpath):
-        return
-    recursive_mkdir(os.path.dirname(fpath))
+    if fpath:
+        os.makedirs(fpath, exist_ok=True)
+
+# Copies a single file, for use as `copy_function` in `shutil.copytree()`. The
+# mode is one of:
+#   "link":    Hard link the destination to the source (no data is copied).
+#   "reflink": Copy in the kernel with copy_file_range(), which shares extents
+#              on filesystems that support it.
+#   "copy":    Regular copy with `shutil.copy2()`.
+# Each mode falls back to the next one if it's not supported. Copies are made
+# in a temporary file which then replaces the destination, so we never write
+# through an existing hard link.
+COPY_MODES = ["link", "reflink", "copy"]
+
+# Errors of os.link() for which copying is a sensible fallback
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP,
+                         errno.EOPNOTSUPP, errno.EMLINK}
+
+def copy_file(src: str, dst: str, mode: str = "copy") -> None:
+    if mode == "link":
+        if os.path.lexists(dst):
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                return
+            os.unlink(dst)
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            # In particular, don't fall back if dst has reappeared in the
+            # meantime; it could be a hard link to another source file.
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+        mode = "reflink"
+
+    fd, tmp = tempfile.mkstemp(prefix=".stdoc-", dir=os.path.dirname(dst) or ".")
     try:
-        os.mkdir(fpath)
-    except FileExistsError:
-        pass
+        with os.fdopen(fd, "wb") as fdst:
+            if mode == "reflink" and hasattr(os, "copy_file_range"):
+                try:
+                    with open(src, "rb") as fsrc:
+                        while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                                 1 << 30):
+                            pass
+                except OSError:
+                    mode = "copy"
+            else:
+                mode = "copy"
+        if mode == "copy":
+            shutil.copy2(src, tmp)
+        else:
+            shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 # This function takes a list/iterable of paths as input, which should be sorted
 # or grouped by a traversal order, and then returns a tree dictionary of the
@@ -79,20 +150,34 @@ def recursive_mkdir(fpath: str) -> None:
 #
 # Folders may be distinguished from files with .endswith("/").
 def nest_paths(paths: Iterable[str]) -> dict[str, Any]:
-    def traverse(org, i, prefix, result):
-        while i < len(org) and org[i].startswith(prefix):
-            suffix = org[i][len(prefix):]
-            if "/" not in suffix:
-                result[suffix] = org[i]
-                i += 1
-            else:
-                subdir = suffix[:suffix.index("/")+1]
-                result[subdir] = dict()
-                i = traverse(org, i, prefix + subdir, result[subdir])
-        return i
-
     r: dict[str, Any] = dict()
-    traverse(paths, 0, "", r)
+    # Folders of the previous path, as (name, dict) pairs starting at the root
+    stack: list[tuple[str, dict[str, Any]]] = []
+
+    current = r
+    prev_prefix = ""
+
+    for path in paths:
+        # Most paths are in the same folder as the previous one
+        folder, sep, name = path.rpartition("/")
+        if folder + sep == prev_prefix:
+            current[name] = path
+            continue
+        prev_prefix = folder + sep
+
+        *folders, name = path.split("/")
+        # Keep the folders shared with the previous path, then descend
+        depth = 0
+        while depth < len(stack) and depth < len(folders) \
+                and stack[depth][0] == folders[depth]:
+            depth += 1
+        del stack[depth:]
+        current = stack[-1][1] if stack else r
+        for folder in folders[depth:]:
+            current = current.setdefault(folder + "/", dict())
+            stack.append((folder, current))
+        current[name] = path
+
     return r
 
 # This function is similar to nest_paths(), but it nests by depth, returning a
@@ -110,14 +195,26 @@ def nest_paths(paths: Iterable[str]) -> dict[str, Any]:
 # -> (1, "g/", None)
 # -> (1, "h", "f/g/h")
 def nest_paths_by_depth(paths):
-    def aux(dic, depth):
-        for key, value in dic.items():
-            if key.endswith("/"):
-                yield (depth, key, None)
-                yield from aux(value, depth+1)
-            else:
-                yield (depth, key, value)
-    yield from aux(nest_paths(paths), 0)
+    # Folders of the previous path; only the ones that differ are yielded
+    prev_folders: list[str] = []
+    prev_prefix = ""
+    for path in paths:
+        # Most paths are in the same folder as the previous one
+        folder, sep, name = path.rpartition("/")
+        if folder + sep == prev_prefix:
+            yield (len(prev_folders), name, path)
+            continue
+        prev_prefix = folder + sep
+
+        *folders, name = path.split("/")
+        common = 0
+        while common < len(prev_folders) and common < len(folders) \
+                and prev_folders[common] == folders[common]:
+            common += 1
+        for depth in range(common, len(folders)):
+            yield (depth, folders[depth] + "/", None)
+        yield (len(folders), name, path)
+        prev_folders = folders
 
 # Path abstractions.
 #
@@ -130,18 +227,98 @@ def nest_paths_by_depth(paths):
 # URLs are interpreted relative to the (unspecified) root URL relative to which
 # the documentation will be deployed.
 
+# Same as os.path.relpath("/", base): one ".." per folder in base, where
+# `depth` is the number of folders (ie. of "/"). Paths with segments that need
+# normalizing go through os.path.
+def _root_relpath(base: str, depth: int) -> str:
+    if base == "/":
+        return "."
+    if "//" in base or "/." in base:
+        return os.path.relpath("/", base)
+    return "/".join([".."] * depth)
+
+# Implementation of AbstractPath._relpath(), memoized since the same pairs of
+# paths come up over and over when linking pages together. `depth` is the
+# precomputed number of "/" in `path`.
+@functools.lru_cache(maxsize=4096)
+def _relpath_cached(path: str, depth: int, target: str) -> str:
+    # Start by removing the file name part of the path, otherwise it gets
+    # interpreted as a folder by relpath(). There's always a file name
+    # unless the path is "/", which is itself unaffected by dirname().
+    base = os.path.dirname(path)
+    # dirname() removes one folder, unless it also strips repeated slashes
+    base_depth = depth - 1 if "//" not in path else base.count("/")
+
+    # Both paths come from validated instances, and the dirname of a valid
+    # path is valid, so only check in debug runs.
+    if __debug__:
+        AbstractPath.assertValid(target)
+        AbstractPath.assertValid(base)
+
+    # Now find how many "../" to go back to the root and join that with the
+    # path to the target.
+
+    # If target is "/", return the ".."-path. We'll get a "/" at the end of
+    # the target URL once interpreter by browser. Such is life. (We can't
+    # avoid that without knowing the full root URL.)
+    if target == "/":
+        result = _root_relpath(base, base_depth)
+    # If base is "/", skip the join to avoid a needless "./". If target starts
+    # with "//", os.path.join() used to keep target[1:] as an absolute path.
+    elif base == "/" or target.startswith("//"):
+        result = target[1:]
+    # Otherwise, join normally.
+    else:
+        result = _root_relpath(base, base_depth) + target
+
+    # print(style("<relpath>", "U"), path, "(" + base + ")", target,
+    #     "->", result)
+    return result
+
 class AbstractPath:
+    # __weakref__ is needed for interning
+    __slots__ = ("_path", "_depth", "__weakref__")
     _path: str
+    # Number of "/" in the path
+    _depth: int
+
+    # Paths are immutable, so instances are interned by class and path; this
+    # avoids lots of duplicates of the same URLs.
+    _instances: "weakref.WeakValueDictionary[tuple[type, str], AbstractPath]" \
+        = weakref.WeakValueDictionary()
 
-    def __init__(self, path: str):
-        AbstractPath.assertValid(path)
-        self._path = path
+    def __new__(cls, path: str):
+        self = AbstractPath._instances.get((cls, path))
+        if self is None:
+            AbstractPath.assertValid(path)
+            self = cls._from_trusted(path)
+        return self
+
+    # Get the instance for a path that is known to be valid, skipping checks.
+    @classmethod
+    def _from_trusted(cls, path: str):
+        self = AbstractPath._instances.get((cls, path))
+        if self is None:
+            self = object.__new__(cls)
+            self._path = path
+            self._depth = path.count("/")
+            AbstractPath._instances[(cls, path)] = self
+        return self
+
+    def __getnewargs__(self) -> tuple[str]:
+        return (self._path,)
 
     def __str__(self) -> str:
         return self._path
 
+    # Equivalent to os.path.join() for our paths, which are always absolute and
+    # only end with "/" if they are the root.
     def _join(self, subpath: str) -> str:
-        return os.path.join(self._path, subpath)
+        if subpath.startswith("/"):
+            return subpath
+        if self._path == "/":
+            return "/" + subpath
+        return self._path + "/" + subpath
 
     def _relpath(self, target: str) -> str:
         """Relative path to another path. While this is a relative path, its
@@ -149,33 +326,7 @@ class AbstractPath:
            then add the target path. This is fairly simple and works around an
            issue where browsers interpret ".." relative to "x/y" to be "x/"
            with an extra slash, which is not how we want page URLs to look."""
-        AbstractPath.assertValid(target)
-
-        # Start by removing the file name part of the path, otherwise it gets
-        # interpreted as a folder by relpath(). There's always a file name
-        # unless the path is "/", which is itself unaffected by dirname().
-        base = os.path.dirname(self._path)
-        AbstractPath.assertValid(base)
-
-        # Now find how many "../" to go back to the root and join that with the
-        # path to the target.
-
-        # If target is "/", return the ".."-path. We'll get a "/" at the end of
-        # the target URL once interpreter by browser. Such is life. (We can't
-        # avoid that without knowing the full root URL.)
-        if target == "/":
-            result = os.path.relpath("/", base)
-        # If base is "/", skip the join to avoid a needless "./".
-        elif base == "/":
-            result = target[1:]
-        # Otherwise, join normally.
-        else:
-            root = os.path.relpath("/", base)
-            result = os.path.join(root, target[1:])
-
-        # print(style("<relpath>", "U"), self._path, "(" + base + ")", target,
-        #     "->", result)
-        return result
+        return _relpath_cached(self._path, self._depth, target)
 
     @staticmethod
     def assertValid(path: str) -> None:
@@ -185,6 +336,8 @@ class AbstractPath:
             raise Exception("invalid path: {}".format(path))
 
 class InputPath(AbstractPath):
+    __slots__ = ()
+
     def __mod__(self, base: "InputPath") -> str:
         assert isinstance(base, InputPath)
         return base._relpath(self._path)
@@ -193,6 +346,8 @@ class InputPath(AbstractPath):
         return InputPath(self._join(subdir))
 
 class Url(AbstractPath):
+    __slots__ = ()
+
     def __mod__(self, base: "Url") -> str:
         assert isinstance(base, Url)
         return base._relpath(self._path)
@@ -201,6 +356,7 @@ class Url(AbstractPath):
         return Url(self._join(subdir))
 
     def addHtmlSuffix(self) -> "Url":
+        # Only "/" ends with "/", and adding a suffix keeps paths valid
         path = self._path
-        path += "index.html" if path.endswith("/") else ".html"
-        return Url(path)
+        return Url._from_trusted(
+            path + "index.html" if path[-1] == "/" else path + ".html")